@@ -3,27 +3,85 @@
 Generate a self-contained wiki markdown file with embedded or local images.
 """
 import argparse
+import os
 import re
 import base64
+import hashlib
+import http.client
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
 from pathlib import Path
-from urllib.parse import quote, urlparse, unquote
+from urllib.parse import quote, urljoin, urlparse, urlsplit, unquote
+import urllib.error
 import urllib.request
 
 IGNORE = {"_Sidebar.md", "_Footer.md", "_Header.md", "Home.md"}
 
-ORDER_RE = re.compile(r"^\s*(?P<num>\d{2})\b")
+# Pages transformed ahead of the writer; bounds the finished sections held in memory
+PAGES_IN_FLIGHT = 64
+
+# Guards the check-then-submit in prefetch_images across page threads,
+# and the image file name claims
+IMAGE_CACHE_LOCK = threading.Lock()
+# Saved image file names: URL -> file name, and file name -> URL. Two URLs
+# sharing a file name (a/x.png and b/x.png) must not be saved over each other
+IMAGE_NAMES = {}
+IMAGE_NAME_OWNERS = {}
+# Per-thread HTTP connections kept alive between downloads, keyed by (scheme, host)
+HTTP_LOCAL = threading.local()
+HTTP_CONNECTIONS = {"http": http.client.HTTPConnection, "https": http.client.HTTPSConnection}
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 10
+# Proxies from the environment; requests through a proxy go via urlopen
+PROXIES = urllib.request.getproxies()
+
+# Leading bytes of the image formats download_image accepts
+IMAGE_SIGNATURES = (
+    b'\xFF\xD8\xFF',  # JPEG
+    b'\x89PNG',  # PNG
+    b'GIF87a',  # GIF
+    b'GIF89a',  # GIF
+    b'<svg',  # SVG
+    b'<?xml',  # SVG (with XML declaration)
+)
+# Leading bytes that mark a downloaded body as an HTML page
+HTML_PREFIXES = (b'<!DOCTYPE', b'<!doctype', b'<html', b'<HTML', b'<?xml')
+
+# Byte table mapping everything except [a-z0-9] to "-" (used by anchor_slug)
+SLUG_TABLE = bytes(c if 0x30 <= c <= 0x39 or 0x61 <= c <= 0x7A else 0x2D for c in range(256))
+# URLs starting with these are left alone by the link/image rewriting
+SPECIAL_URL_PREFIXES = ("http://", "https://", "data:", "mailto:", "#")
+# "-" and "_" act as word separators in page names and keys
+SEP_TABLE = str.maketrans("-_", "  ")
+
 H1_RE = re.compile(r"^\s*#\s+(.*)$", re.MULTILINE)
-FENCE_RE = re.compile(r"^(```|~~~)")
 WIKI_LINK_RE = re.compile(r"\[\[([^\]|]+)(?:\|([^\]]+))?\]\]")
 MD_IMG_RE = re.compile(r"!\[(?P<alt>[^\]]*)\]\((?P<url>(?:[^)]|\([^)]*\))+)\)")
-HTML_IMG_RE = re.compile(r'<img\b[^>]*\bsrc\s*=\s*"([^"]+)"[^>]*>', re.IGNORECASE)
+HTML_IMG_RE = re.compile(r'<img\b[^>]*\bsrc\s*=\s*"(?P<src>[^"]+)"[^>]*>', re.IGNORECASE)
+# Case-insensitive "<img" probe; scans the text without a lowered copy
+HTML_IMG_PROBE_RE = re.compile("<img", re.IGNORECASE)
 MD_LINK_RE = re.compile(r"(?<!\!)\[(?P<label>[^\]]+)\]\((?P<target>[^)]+)\)")
 SETEXT_RE = re.compile(r"^(?P<title>.+?)\n(?P<underline>=+|-+)\s*$", re.MULTILINE)
-ATX_RE = re.compile(r"^(?P<hashes>#{1,6})(?P<sp>\s+)(?P<text>.+?)\s*$")
-
-
-def read_text(p: Path) -> str:
-    return p.read_text(encoding="utf-8", errors="ignore")
+# A code fence opener/closer or an ATX heading, one line at a time ([^\S\n] = whitespace but newline)
+FENCE_OR_ATX_RE = re.compile(
+    r"^(?:(?P<fence>[^\S\n]*(?:```|~~~))"
+    r"|(?P<hashes>#{1,6})(?P<sp>[^\S\n]+)(?P<text>.+?)[^\S\n]*$)",
+    re.MULTILINE,
+)
+OG_IMAGE_RE = re.compile(r'<meta\s+property="og:image"\s+content="([^"]+)"')
+PAGE_IMG_RE = re.compile(r'<img[^>]+src="([^"]+)"[^>]*>')
+
+
+def read_text(path: str) -> str:
+    # One bulk decode instead of a TextIOWrapper; newlines normalized as in text mode
+    with open(path, "rb") as f:
+        text = f.read().decode("utf-8", "ignore")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
 
 
 def find_first_h1(text: str) -> str | None:
@@ -32,16 +90,19 @@ def find_first_h1(text: str) -> str | None:
 
 
 def page_title_from_filename(p: Path) -> str:
-    return p.stem.replace("-", " ").replace("_", " ").strip()
+    return p.stem.translate(SEP_TABLE).strip()
 
 
-def extract_order_and_title(p: Path, text: str):
-    clean_stem = strip_numeric_prefix(p.stem)
-    title = clean_stem.replace("-", " ").replace("_", " ").strip()
-    m = ORDER_RE.match(p.stem)
-    return (int(m.group("num")) if m else None), title
+def extract_order_and_title(stem: str):
+    clean_stem = strip_numeric_prefix(stem)
+    title = clean_stem.translate(SEP_TABLE).strip()
+    # Hand-rolled ^\s*(\d{2})\b, as in extract_sort_key
+    s = stem.lstrip()
+    order = int(s[:2]) if len(s) >= 2 and s[:2].isdecimal() and not is_word_char(s[2:3]) else None
+    return order, title
 
 
+@lru_cache(maxsize=None)
 def strip_numeric_prefix(s: str) -> str:
     """Remove everything up to and including the first hyphen, then strip leading spaces and hyphens.
     Handles both ASCII hyphen (-) and Unicode HYPHEN (‐, U+2010)."""
@@ -51,43 +112,49 @@ def strip_numeric_prefix(s: str) -> str:
     return s
 
 
+def is_word_char(c: str) -> bool:
+    """True if c is a character matched by the regex \\w (False for "")."""
+    return c.isalnum() or c == "_"
+
+
 def extract_sort_key(stem: str):
     """Extract (2-digit number, optional letter) for sorting."""
-    m = re.match(r'^\s*(\d{2})([a-z])?\b', stem, re.IGNORECASE)
-    if m:
-        num = int(m.group(1))
-        letter = (m.group(2) or '').lower()
-        return (num, letter)
+    # Hand-rolled ^\s*(\d{2})([a-z])?\b (case-insensitive): no regex engine needed
+    s = stem.lstrip()
+    if len(s) >= 2 and s[:2].isdecimal():
+        num = int(s[:2])
+        letter = s[2:3]
+        if letter.isascii() and letter.isalpha() and not is_word_char(s[3:4]):
+            return (num, letter.lower())
+        if not is_word_char(letter):
+            return (num, '')
     return (999, '')
 
 
+@lru_cache(maxsize=None)
 def anchor_slug(t: str) -> str:
-    t = t.lower()
-    t = re.sub(r"[^a-z0-9]+", "-", t).strip("-")
-    return t
+    # Non-ASCII characters become "?" and are then dashed by the table
+    s = t.lower().encode("ascii", "replace").translate(SLUG_TABLE).decode("ascii")
+    return "-".join(filter(None, s.split("-")))
 
 
+@lru_cache(maxsize=None)
 def normalize_key(s: str) -> str:
     """Normalize a page identifier for dictionary keys (case/sep tolerant)."""
-    s = s.strip().lower()
-    s = s.replace("_", " ").replace("-", " ")
-    s = re.sub(r"\s+", " ", s)
-    return s
+    # split() without arguments drops leading/trailing runs and collapses the rest
+    return " ".join(s.lower().translate(SEP_TABLE).split())
 
 
 def build_page_keyset(title: str, stem: str):
     """Return a set of normalized keys that may refer to this page."""
-    keys = set()
-    variants = [
+    # normalize_key already maps "-"/"_" to spaces, so the stem covers its
+    # separator-translated variant; the raw set drops remaining duplicates.
+    return {normalize_key(v) for v in {
         title,
         strip_numeric_prefix(title),
         stem,
         strip_numeric_prefix(stem),
-        stem.replace("-", " ").replace("_", " "),
-    ]
-    for v in variants:
-        keys.add(normalize_key(v))
-    return keys
+    }}
 
 
 def convert_setext_to_atx(text: str) -> str:
@@ -102,20 +169,23 @@ def convert_setext_to_atx(text: str) -> str:
 
 
 def demote_atx_headings_outside_code(text: str) -> str:
-    out_lines, in_code = [], False
-    for line in text.splitlines():
-        if FENCE_RE.match(line.strip()):
+    # Pages without any "#" have nothing to demote
+    if "#" not in text:
+        return text
+    # Single scan over fences and headings; text between matches is copied as-is
+    out, pos, in_code = [], 0, False
+    for m in FENCE_OR_ATX_RE.finditer(text):
+        if m.group("fence") is not None:
             in_code = not in_code
-            out_lines.append(line)
             continue
         if not in_code:
-            m = ATX_RE.match(line)
-            if m:
-                level = len(m.group("hashes"))
-                new_level = min(level + 1, 6)
-                line = "#" * new_level + m.group("sp") + m.group("text")
-        out_lines.append(line)
-    return "\n".join(out_lines)
+            level = len(m.group("hashes"))
+            new_level = min(level + 1, 6)
+            out.append(text[pos:m.start()])
+            out.append("#" * new_level + m.group("sp") + m.group("text"))
+            pos = m.end()
+    out.append(text[pos:])
+    return "".join(out)
 
 
 def normalize_heading(page_title: str, content: str) -> str:
@@ -126,14 +196,7 @@ def normalize_heading(page_title: str, content: str) -> str:
 
 
 def is_absolute_or_special(url: str) -> bool:
-    u = url.strip()
-    return (
-        u.startswith("http://")
-        or u.startswith("https://")
-        or u.startswith("data:")
-        or u.startswith("mailto:")
-        or u.startswith("#")
-    )
+    return url.lstrip().startswith(SPECIAL_URL_PREFIXES)
 
 
 def github_blob_to_raw(url: str) -> str:
@@ -149,13 +212,13 @@ def extract_image_from_html(html_content: bytes, base_url: str) -> str | None:
     try:
         html_str = html_content.decode('utf-8', errors='ignore')
         # Look for og:image meta tag (common in GitHub pages)
-        match = re.search(r'<meta\s+property="og:image"\s+content="([^"]+)"', html_str)
+        match = OG_IMAGE_RE.search(html_str)
         if match:
             img_url = match.group(1)
             # Convert blob URLs to raw before returning
             return github_blob_to_raw(img_url) if img_url.startswith('http') else img_url
         # Look for img tags
-        match = re.search(r'<img[^>]+src="([^"]+)"[^>]*>', html_str)
+        match = PAGE_IMG_RE.search(html_str)
         if match:
             img_url = match.group(1)
             # Make absolute if relative
@@ -171,67 +234,108 @@ def extract_image_from_html(html_content: bytes, base_url: str) -> str | None:
     return None
 
 
+def get_connection(scheme: str, netloc: str) -> http.client.HTTPConnection:
+    """Return the calling thread's open connection to netloc, creating it if needed."""
+    conns = HTTP_LOCAL.__dict__.setdefault("conns", {})
+    conn = conns.get((scheme, netloc))
+    if conn is None:
+        conn = conns[(scheme, netloc)] = HTTP_CONNECTIONS[scheme](netloc, timeout=10)
+    return conn
+
+
+def drop_connection(scheme: str, netloc: str) -> None:
+    """Close and forget the calling thread's connection to netloc."""
+    conn = HTTP_LOCAL.__dict__.get("conns", {}).pop((scheme, netloc), None)
+    if conn is not None:
+        conn.close()
+
+
+def http_request(scheme: str, netloc: str, target: str,
+                 headers: dict) -> tuple[http.client.HTTPResponse, bytes]:
+    """GET target on the calling thread's connection to netloc."""
+    reused = (scheme, netloc) in HTTP_LOCAL.__dict__.get("conns", {})
+    try:
+        conn = get_connection(scheme, netloc)
+        conn.request("GET", target, headers=headers)
+        response = conn.getresponse()
+        return response, response.read()
+    except (http.client.HTTPException, OSError):
+        drop_connection(scheme, netloc)
+        if not reused:
+            raise
+    # The server closed the idle connection in between; retry on a new one
+    return http_request(scheme, netloc, target, headers)
+
+
+def http_get(url: str, headers: dict) -> tuple[str, bytes]:
+    """GET url and return (Content-Type, body), following redirects.
+    Connections stay open for the next download from the same host, so
+    images from one server share a single TCP/TLS handshake per thread."""
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        if parts.scheme in PROXIES:
+            request = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.headers.get('Content-Type', ''), response.read()
+        if parts.scheme not in HTTP_CONNECTIONS:
+            raise ValueError(f"unknown url type: {url!r}")
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        response, data = http_request(parts.scheme, parts.netloc, target, headers)
+        if response.will_close:
+            drop_connection(parts.scheme, parts.netloc)
+        location = response.headers.get('Location')
+        if response.status in REDIRECT_CODES and location:
+            url = urljoin(url, location)
+            continue
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+        return response.headers.get('Content-Type', ''), data
+    raise urllib.error.HTTPError(url, response.status, "Too many redirects", response.headers, None)
+
+
 def download_image(url: str) -> bytes | None:
     """Download image from URL and return bytes. Handles HTML pages that link to images."""
     try:
         # Follow redirects and get actual content
-        request = urllib.request.Request(url)
-        request.add_header('User-Agent', 'Mozilla/5.0')
+        content_type, data = http_get(url, {'User-Agent': 'Mozilla/5.0'})
+        # Comprehensive HTML detection
+        head = data[:200].lower()
+        is_html = (
+            'text/html' in content_type or
+            'application/xhtml' in content_type or
+            data.startswith(HTML_PREFIXES) or
+            b'<html' in head or
+            b'<!doctype html' in head
+        )
         
-        with urllib.request.urlopen(request, timeout=10) as response:
-            content_type = response.headers.get('Content-Type', '')
-            data = response.read()
-            
-            # Comprehensive HTML detection
-            is_html = (
-                'text/html' in content_type or
-                'application/xhtml' in content_type or
-                data.startswith(b'<!DOCTYPE') or
-                data.startswith(b'<!doctype') or
-                data.startswith(b'<html') or
-                data.startswith(b'<HTML') or
-                data.startswith(b'<?xml') or
-                b'<html' in data[:200].lower() or
-                b'<!doctype html' in data[:200].lower()
-            )
-            
-            if is_html:
-                print(f"Got HTML page for {url}, attempting to extract image URL...")
-                img_url = extract_image_from_html(data, url)
-                if img_url:
-                    print(f"Found image URL: {img_url}")
-                    # Recursively download the actual image (with depth limit)
-                    if '_recursion_depth' not in url:
-                        return download_image(img_url + '?_recursion_depth=1')
-                    else:
-                        print(f"Warning: Recursion depth limit reached for {url}")
-                        return None
+        if is_html:
+            print(f"Got HTML page for {url}, attempting to extract image URL...")
+            img_url = extract_image_from_html(data, url)
+            if img_url:
+                print(f"Found image URL: {img_url}")
+                # Recursively download the actual image (with depth limit)
+                if '_recursion_depth' not in url:
+                    return download_image(img_url + '?_recursion_depth=1')
                 else:
-                    print(f"Warning: Got HTML but couldn't extract image URL for {url}")
+                    print(f"Warning: Recursion depth limit reached for {url}")
                     return None
-            
-            # Verify content type is an image
-            if not content_type.startswith('image/'):
-                print(f"Warning: Non-image content type '{content_type}' for {url}")
-                print(f"  Content start: {data[:100]}")
+            else:
+                print(f"Warning: Got HTML but couldn't extract image URL for {url}")
                 return None
+        
+        # Verify content type is an image
+        if not content_type.startswith('image/'):
+            print(f"Warning: Non-image content type '{content_type}' for {url}")
+            print(f"  Content start: {data[:100]}")
+            return None
+        
+        # Verify data looks like an image (starts with common image magic bytes)
+        if not data.startswith(IMAGE_SIGNATURES):
+            print(f"Warning: Data doesn't start with known image signature for {url}")
+            print(f"  First bytes: {data[:20]}")
+            return None
             
-            # Verify data looks like an image (starts with common image magic bytes)
-            image_signatures = [
-                b'\xFF\xD8\xFF',  # JPEG
-                b'\x89PNG',  # PNG
-                b'GIF87a',  # GIF
-                b'GIF89a',  # GIF
-                b'<svg',  # SVG
-                b'<?xml',  # SVG (with XML declaration)
-            ]
-            
-            if not any(data.startswith(sig) for sig in image_signatures):
-                print(f"Warning: Data doesn't start with known image signature for {url}")
-                print(f"  First bytes: {data[:20]}")
-                return None
-                
-            return data
+        return data
     except Exception as e:
         print(f"Warning: Failed to download {url}: {e}")
         return None
@@ -266,116 +370,208 @@ def to_raw_wiki_url(repo: str, path_like: str) -> str:
     return f"https://raw.githubusercontent.com/{repo}.wiki/HEAD/{quote(url_part)}"
 
 
-def process_images(text: str, repo: str, embed: bool, images_dir: Path | None, image_cache: dict) -> str:
-    """Process markdown and HTML images - either embed as base64 or save to folder."""
+def resolve_image_url(url: str, repo: str) -> str | None:
+    """Absolute download URL for an image reference, or None for data: URIs and anchors."""
+    url_clean = url.split(" ", 1)[0].strip(' "\'')
     
-    def process_img(url: str, alt: str = "") -> str:
-        """Process a single image URL."""
-        url_clean = url.split(" ", 1)[0].strip(' "\'')
-        
-        if is_absolute_or_special(url_clean):
-            if not url_clean.startswith("http"):
-                return url  # Keep data: URIs and anchors as-is
-            # Convert GitHub blob URLs to raw URLs
-            full_url = github_blob_to_raw(url_clean)
-        else:
-            full_url = to_raw_wiki_url(repo, url)
-        
-        # Check cache
-        if full_url in image_cache:
-            return image_cache[full_url]
-        
-        # Download image
-        img_data = download_image(full_url)
-        if not img_data:
-            # If it's a blob URL, convert to raw and try again
-            if '/blob/' in full_url:
-                raw_url = github_blob_to_raw(full_url)
-                if raw_url != full_url:
-                    print(f"Retrying with raw URL: {raw_url}")
-                    img_data = download_image(raw_url)
-                    if img_data:
-                        full_url = raw_url  # Use raw URL for cache
-                    else:
-                        # Still failed - keep original URL but warn
-                        print(f"ERROR: Failed to download even after converting to raw: {raw_url}")
-                        image_cache[full_url] = url
-                        return url
-            else:
-                image_cache[full_url] = url  # Keep original on failure
-                return url
-        
-        if embed:
-            # Embed as base64 data URI
-            mime_type = get_image_mime_type(full_url, img_data)
-            b64_data = base64.b64encode(img_data).decode('ascii')
-            new_url = f"data:{mime_type};base64,{b64_data}"
-        else:
-            # Save to images directory
-            if images_dir is None:
-                image_cache[full_url] = url
-                return url
-            
-            # Generate filename from URL - decode URL encoding first
-            parsed = urlparse(full_url)
-            filename = Path(parsed.path).name
-            if not filename:
-                filename = f"image_{len(image_cache)}.png"
-            
-            # URL-decode the filename to get actual filename with spaces/special chars
-            filename = unquote(filename)
-            
-            img_path = images_dir / filename
-            
-            # Only write if file doesn't already exist (avoid duplicates)
-            if not img_path.exists():
-                img_path.write_bytes(img_data)
-            
-            # Use actual filename (with spaces) for markdown reference
-            # This works with Pandoc/LaTeX and most markdown viewers
-            new_url = f"images/{filename}"
-        
-        image_cache[full_url] = new_url
-        return new_url
+    if is_absolute_or_special(url_clean):
+        if not url_clean.startswith("http"):
+            return None  # Keep data: URIs and anchors as-is
+        # Convert GitHub blob URLs to raw URLs
+        return github_blob_to_raw(url_clean)
+    return to_raw_wiki_url(repo, url)
+
+
+def url_digest(full_url: str) -> str:
+    """SHA-256 of a URL, used to name files derived from it."""
+    return hashlib.sha256(full_url.encode('utf-8')).hexdigest()
+
+
+def write_file_atomic(path: Path, data: bytes) -> None:
+    """Write under a temporary name first so readers never see a partial file."""
+    tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def load_image(full_url: str, cache_dir: Path | None) -> bytes | None:
+    """download_image() backed by an optional on-disk cache shared by the runs of one build.
+    Files are named after the SHA-256 of the URL; only successful downloads are cached.
+    Entries are never revalidated, so the cache must not outlive the build."""
+    if cache_dir is None:
+        return download_image(full_url)
+    
+    cache_path = cache_dir / f"{url_digest(full_url)}.bin"
+    if cache_path.is_file():
+        return cache_path.read_bytes()
+    
+    img_data = download_image(full_url)
+    if img_data:
+        write_file_atomic(cache_path, img_data)
+    return img_data
+
+
+def image_filename(full_url: str) -> str:
+    """File name an image URL is saved under in the images folder; the caller
+    holds IMAGE_CACHE_LOCK. The first URL to claim a name keeps it, later URLs
+    with the same name get their digest appended."""
+    filename = IMAGE_NAMES.get(full_url)
+    if filename is not None:
+        return filename
     
-    # Process markdown images
-    def repl_md(m):
-        alt = m.group("alt")
-        url_token = m.group("url").strip()
-        new_url = process_img(url_token, alt)
-        return f"![{alt}]({new_url})"
+    # Generate filename from URL - decode URL encoding first
+    parsed = urlparse(full_url)
+    filename = Path(parsed.path).name
+    if not filename:
+        # Named after the URL: downloads finish in any order, so a counter
+        # would give different names on different runs
+        filename = f"image_{url_digest(full_url)[:16]}.png"
     
-    text = MD_IMG_RE.sub(repl_md, text)
+    # URL-decode the filename to get actual filename with spaces/special chars
+    filename = unquote(filename)
     
-    # Process HTML images
-    def repl_html(m):
-        full = m.group(0)
-        src_url = m.group(1)
-        new_url = process_img(src_url)
-        return full.replace(f'src="{src_url}"', f'src="{new_url}"')
+    if IMAGE_NAME_OWNERS.setdefault(filename, full_url) != full_url:
+        stem, suffix = os.path.splitext(filename)
+        filename = f"{stem}_{url_digest(full_url)[:8]}{suffix}"
+        IMAGE_NAME_OWNERS[filename] = full_url
+    IMAGE_NAMES[full_url] = filename
+    return filename
+
+
+def store_image(full_url: str, embed: bool, images_dir: Path | None,
+                cache_dir: Path | None) -> str | None:
+    """Download an image and embed it as base64 or save it to the images folder.
+    Returns the URL to use in the output, or None if the image could not be fetched."""
+    img_data = load_image(full_url, cache_dir)
+    if not img_data:
+        return None
+    
+    if embed:
+        # Embed as base64 data URI; each intermediate is dropped as soon as
+        # the next one exists, so at most two copies are alive at a time
+        mime_type = get_image_mime_type(full_url, img_data)
+        encoded = base64.b64encode(img_data)
+        del img_data
+        data_uri = f"data:{mime_type};base64,".encode('ascii') + encoded
+        del encoded
+        return data_uri.decode('ascii')
+    
+    # Save to images directory
+    if images_dir is None:
+        return None
+    
+    with IMAGE_CACHE_LOCK:
+        filename = image_filename(full_url)
+    img_path = images_dir / filename
     
-    text = HTML_IMG_RE.sub(repl_html, text)
+    # Only write if file doesn't already exist (avoid duplicates); the same
+    # URL may still be fetched twice at once, hence the atomic write
+    if not img_path.exists():
+        write_file_atomic(img_path, img_data)
     
+    # Use actual filename (with spaces) for markdown reference
+    # This works with Pandoc/LaTeX and most markdown viewers
+    return f"images/{filename}"
+
+
+def prefetch_images(text: str, repo: str, embed: bool, images_dir: Path | None,
+                    image_cache: dict, cache_dir: Path | None,
+                    pool: ThreadPoolExecutor) -> None:
+    """Start fetching every image referenced in text on the download pool.
+    image_cache maps the download URL to a Future of the output URL, so each
+    image is fetched once however many pages refer to it."""
+    urls = []
+    # Cheap substring probes first; most pages have no images at all
+    if "![" in text:
+        urls += [m.group("url").strip() for m in MD_IMG_RE.finditer(text)]
+    if HTML_IMG_PROBE_RE.search(text):
+        urls += [m.group("src") for m in HTML_IMG_RE.finditer(text)]
+    for url in urls:
+        full_url = resolve_image_url(url, repo)
+        if full_url is None:
+            continue
+        with IMAGE_CACHE_LOCK:
+            if full_url not in image_cache:
+                # Claim the file name now, in the order the images are referenced
+                if images_dir is not None:
+                    image_filename(full_url)
+                image_cache[full_url] = pool.submit(store_image, full_url, embed, images_dir,
+                                                    cache_dir)
+
+
+def process_image(url: str, repo: str, embed: bool, images_dir: Path | None,
+                  image_cache: dict, cache_dir: Path | None) -> str:
+    """Process a single image URL - either embed as base64 or save to folder."""
+    full_url = resolve_image_url(url, repo)
+    if full_url is None:
+        return url
+    
+    # Normally prefetched; otherwise fetch now and cache the result the same way
+    future = image_cache.get(full_url)
+    if future is None:
+        future = Future()
+        future.set_result(store_image(full_url, embed, images_dir, cache_dir))
+        future = image_cache.setdefault(full_url, future)
+    # Keep original on failure
+    return future.result() or url
+
+
+def rewrite_md_image(m: re.Match, repo: str, embed: bool, images_dir: Path | None,
+                     image_cache: dict, cache_dir: Path | None) -> str:
+    """Replacement for a markdown image match (groups "alt" and "url")."""
+    alt = m.group("alt")
+    url_token = m.group("url").strip()
+    new_url = process_image(url_token, repo, embed, images_dir, image_cache, cache_dir)
+    return f"![{alt}]({new_url})"
+
+
+def rewrite_html_image(m: re.Match, repo: str, embed: bool, images_dir: Path | None,
+                       image_cache: dict, cache_dir: Path | None) -> str:
+    """Replacement for an HTML <img> match (group "src")."""
+    full = m.group(0)
+    new_url = process_image(m.group("src"), repo, embed, images_dir, image_cache, cache_dir)
+    # Splice the new URL in place of the captured src value
+    start, end = m.start("src") - m.start(), m.end("src") - m.start()
+    return full[:start] + new_url + full[end:]
+
+
+def process_images(text: str, repo: str, embed: bool, images_dir: Path | None,
+                   image_cache: dict, cache_dir: Path | None) -> str:
+    """Process markdown and HTML images - either embed as base64 or save to folder."""
+    # Markdown images first, then HTML images; each pass only runs if its
+    # substring probe finds something
+    if "![" in text:
+        text = MD_IMG_RE.sub(
+            lambda m: rewrite_md_image(m, repo, embed, images_dir, image_cache, cache_dir), text)
+    if HTML_IMG_PROBE_RE.search(text):
+        text = HTML_IMG_RE.sub(
+            lambda m: rewrite_html_image(m, repo, embed, images_dir, image_cache, cache_dir), text)
     return text
 
 
-def collect_pages(wiki_dir: Path):
-    for p in sorted(wiki_dir.glob("*.md")):
-        if p.name in IGNORE:
-            continue
-        yield p
+def collect_pages(wiki_dir: str):
+    """Yield the file names of the wiki pages, sorted. Plain strings, no Path objects."""
+    with os.scandir(wiki_dir) as it:
+        names = [e.name for e in it if e.name.endswith(".md") and e.name not in IGNORE]
+    names.sort()
+    yield from names
+
+
+def lookup_page_anchor(page: str, page_anchor_map: dict) -> str | None:
+    """Anchor of a known page, also trying the name without its numeric prefix."""
+    return (page_anchor_map.get(normalize_key(page))
+            or page_anchor_map.get(normalize_key(strip_numeric_prefix(page))))
 
 
 def rewrite_wiki_links_to_local(text: str, page_anchor_map: dict) -> str:
     """[[Page]] / [[Page|Text]] -> local anchors if known."""
+    if "[[" not in text:
+        return text
+    
     def repl(m):
         page = m.group(1).strip()
         label = m.group(2).strip() if m.group(2) else page
-        key = normalize_key(page)
-        anchor = page_anchor_map.get(key)
-        if not anchor:
-            key2 = normalize_key(strip_numeric_prefix(page))
-            anchor = page_anchor_map.get(key2)
+        anchor = lookup_page_anchor(page, page_anchor_map)
         if anchor:
             return f"[{label}](#{anchor})"
         return m.group(0)
@@ -384,6 +580,9 @@ def rewrite_wiki_links_to_local(text: str, page_anchor_map: dict) -> str:
 
 def rewrite_md_links_to_local(text: str, page_anchor_map: dict) -> str:
     """Rewrite [label](Target) where Target is a relative reference to another page."""
+    if "](" not in text:
+        return text
+    
     def repl(m):
         label = m.group("label")
         target = m.group("target").strip()
@@ -396,16 +595,35 @@ def rewrite_md_links_to_local(text: str, page_anchor_map: dict) -> str:
         name = Path(url_only).name
         if name.lower().endswith(".md"):
             name = name[:-3]
-        name = name.replace("-", " ").replace("_", " ").strip()
+        name = name.translate(SEP_TABLE).strip()
         
-        key = normalize_key(name)
-        anchor = page_anchor_map.get(key) or page_anchor_map.get(normalize_key(strip_numeric_prefix(name)))
+        anchor = lookup_page_anchor(name, page_anchor_map)
         if anchor:
             return f"[{label}](#{anchor})"
         return m.group(0)
     return MD_LINK_RE.sub(repl, text)
 
 
+def transform_page(p: dict, repo: str, embed: bool, images_dir: Path | None,
+                   image_cache: dict, cache_dir: Path | None, page_anchor_map: dict,
+                   pool: ThreadPoolExecutor) -> bytes:
+    """Turn one page into its UTF-8 output section. Safe to run for several pages at once."""
+    # Read the page here so its text is only alive while it is transformed
+    raw = read_text(p["path"])
+    # 0) Start all image downloads of the page before rewriting it
+    prefetch_images(raw, repo, embed, images_dir, image_cache, cache_dir, pool)
+    # 1) Rewrite wiki links to local anchors
+    t = rewrite_wiki_links_to_local(raw, page_anchor_map)
+    # 2) Rewrite relative links to local anchors
+    t = rewrite_md_links_to_local(t, page_anchor_map)
+    # 3) Process images (embed or save to folder)
+    t = process_images(t, repo, embed, images_dir, image_cache, cache_dir)
+    # 4) Demote headings and add H1 section title
+    section = normalize_heading(p["title"], t).rstrip()
+    # 5) Add provenance footnote
+    return f"{section}\n\n<sub>Original page: [{p['name']}]({p['url']})</sub>\n".encode("utf-8")
+
+
 def main():
     ap = argparse.ArgumentParser(description="Generate self-contained wiki markdown")
     ap.add_argument("--wiki-dir", required=True, help="Wiki directory path")
@@ -414,9 +632,12 @@ def main():
     ap.add_argument("--embed-images", action="store_true",
                     help="Embed images as base64 (default: save to subfolder)")
     ap.add_argument("--timestamp", help="Generation timestamp for version info")
+    ap.add_argument("--cache-dir",
+                    help="Directory for downloaded images, shared by the runs of one build; entries "
+                         "are never revalidated, so use a fresh directory per build (default: no cache)")
     args = ap.parse_args()
     
-    wiki_dir = Path(args.wiki_dir)
+    wiki_dir = args.wiki_dir
     # Adjust output filename based on mode
     base_out = Path(args.out)
     if args.embed_images:
@@ -431,68 +652,87 @@ def main():
         images_dir.mkdir(parents=True, exist_ok=True)
     
     image_cache = {}
+    cache_dir = None
+    if args.cache_dir:
+        cache_dir = Path(args.cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
     
-    # First pass: read all pages, compute titles/orders
+    # First pass: compute titles/orders from file names (contents are read in the second pass)
     pages = []
-    for md in collect_pages(wiki_dir):
-        raw = read_text(md)
-        order, title = extract_order_and_title(md, raw)
+    for name in collect_pages(wiki_dir):
+        stem = name[:-3]  # collect_pages only yields "*.md"
+        order, title = extract_order_and_title(stem)
         pages.append({
-            "path": md,
-            "raw": raw,
+            "path": os.path.join(wiki_dir, name),
             "order": 999 if order is None else order,
             "title": title,
-            "stem": md.stem,
+            "stem": stem,
+            "name": name,
+            "url": f"https://github.com/{args.repo}/wiki/{quote(stem)}",
+            "anchor": anchor_slug(title),
+            "sort_key": extract_sort_key(stem),
         })
     
     # Sort by 2-digit number, then optional letter
-    pages.sort(key=lambda x: extract_sort_key(x["path"].stem))
+    pages.sort(key=itemgetter("sort_key"))
     
     # Build anchor map
-    page_anchor_map = {}
-    for p in pages:
-        anchor = anchor_slug(p["title"])
-        for k in build_page_keyset(p["title"], p["stem"]):
-            page_anchor_map.setdefault(k, anchor)
+    # Iterate in reverse so the first page claiming a key wins.
+    page_anchor_map = {
+        k: p["anchor"]
+        for p in reversed(pages)
+        for k in build_page_keyset(p["title"], p["stem"])
+    }
     
     # Second pass: transform content
-    output_sections = []
-    
-    # TOC with version info
-    repo_name = args.repo.split('/')[-1]
-    toc = []
-    toc.append(f"# {repo_name} compiled wiki pages\n")
-    toc.append(f"_Self-contained version with {'embedded' if args.embed_images else 'local'} images_\n")
-    
-    # Add version preamble if timestamp provided
-    if args.timestamp:
-        toc.append("\n## Version\n")
-        toc.append(f"This document was generated on {args.timestamp}\n")
-    
-    # Note: Table of Contents is auto-generated by Pandoc using --toc flag
-    
-    output_sections.append("\n".join(toc))
-    
-    for p in pages:
-        # 1) Rewrite wiki links to local anchors
-        t = rewrite_wiki_links_to_local(p["raw"], page_anchor_map)
-        # 2) Rewrite standard relative links to local anchors
-        t = rewrite_md_links_to_local(t, page_anchor_map)
-        # 3) Process images
-        t = process_images(t, args.repo, args.embed_images, images_dir, image_cache)
-        # 4) Demote headings and add H1 section title
-        section = normalize_heading(p["title"], t).rstrip()
-        # 5) Add provenance footnote
-        url = f"https://github.com/{args.repo}/wiki/{quote(p['path'].stem)}"
-        section += f"\n\n<sub>Original page: [{p['path'].name}]({url})</sub>\n"
-        output_sections.append("\n---\n" + section)
-    
+    # Sections are written out in page order as they complete; at most
+    # PAGES_IN_FLIGHT of them are pending or waiting for the writer.
+    # They go to a temporary file that replaces out_path only once every
+    # page is written, so a failing page leaves the previous output intact
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text("\n".join(output_sections) + "\n", encoding="utf-8")
+    tmp_path = out_path.with_name(f".{out_path.name}.tmp")
+    try:
+        with tmp_path.open("wb", buffering=1 << 20) as out:
+            # TOC with version info
+            repo_name = args.repo.split('/')[-1]
+            out.write(f"# {repo_name} compiled wiki pages\n\n".encode("utf-8"))
+            out.write(f"_Self-contained version with {'embedded' if args.embed_images else 'local'} images_\n\n".encode("utf-8"))
+            
+            # Add version preamble if timestamp provided
+            if args.timestamp:
+                out.write(b"\n## Version\n\n")
+                out.write(f"This document was generated on {args.timestamp}\n\n".encode("utf-8"))
+            
+            # Note: Table of Contents is auto-generated by Pandoc using --toc flag
+            
+            def write_section(section: bytes) -> None:
+                # Blank line and horizontal rule before each section
+                out.write(b"\n---\n")
+                out.write(section)
+                out.write(b"\n")
+            
+            # Pages are independent and transformed on their own threads;
+            # images are downloaded on a separate, larger pool (network bound).
+            # A new page is only submitted once the oldest one has been written.
+            with ThreadPoolExecutor(max_workers=32) as pool, ThreadPoolExecutor() as ex:
+                in_flight = deque()
+                for p in pages:
+                    if len(in_flight) >= PAGES_IN_FLIGHT:
+                        write_section(in_flight.popleft().result())
+                    in_flight.append(ex.submit(transform_page, p, args.repo, args.embed_images,
+                                               images_dir, image_cache, cache_dir,
+                                               page_anchor_map, pool))
+                while in_flight:
+                    write_section(in_flight.popleft().result())
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, out_path)
     
     print(f"✓ Generated {out_path}")
     if not args.embed_images and images_dir:
-        img_count = len(list(images_dir.glob("*")))
+        with os.scandir(images_dir) as it:
+            img_count = sum(1 for _ in it)
         print(f"✓ Downloaded {img_count} images to {images_dir}")
 
 